@@ -3,24 +3,41 @@
 """IRC Channel Timebox Keeper."""
 
 
+import asyncio
+import functools
+import heapq
 import json
 import logging
+import os
 import pathlib
-import select
+import signal
 import socket
 import ssl
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 _NAME = 'tzero'
 _log = logging.getLogger(_NAME)
 
 
 class _ctx:
     retry_delay = 1
+    state_dirty = False
+    state_write_delay = 10
+    clean_delay = 60
+    sock_buffer_size = 65536
     state = {
         'timebox': {}
     }
+    deadlines = []
+    timer = None
     commands = {}
+    command_prefixes = {}
+    command_list = ''
 
 
 def main():
@@ -37,12 +54,17 @@ def main():
     _write_state(config['state'])
 
     # Run application forever.
-    _set_up_commands()
+    _set_up_commands(config['prefix'])
+    blocked_words = frozenset(config['block'])
     while True:
         try:
-            _run(config['host'], config['port'], config['tls'],
-                 config['nick'], config['password'], config['channels'],
-                 config['prefix'], config['block'], config['state'])
+            asyncio.run(_run(
+                config['host'], config['port'], config['tls'],
+                config['nick'], config['password'], config['channels'],
+                config['prefix'], blocked_words, config['state']))
+        except asyncio.CancelledError:
+            _log.info('Terminated')
+            return
         except Exception:
             _log.exception('Client encountered error')
             _log.info('Reconnecting in %d s', _ctx.retry_delay)
@@ -50,30 +72,50 @@ def main():
             _ctx.retry_delay = min(_ctx.retry_delay * 2, 3600)
 
 
-def _run(host, port, tls,
-         nick, password, channels,
-         prefix, blocked_words, state_filename):
+async def _run(host, port, tls,
+               nick, password, channels,
+               prefix, blocked_words, state_filename):
+    # Cancel this coroutine on SIGTERM, so that the pending state is
+    # written before the process exits.
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
     _log.info('Connecting ...')
-    sock = socket.create_connection((host, port))
-    if tls:
-        tls_context = ssl.create_default_context()
-        sock = tls_context.wrap_socket(sock, server_hostname=host)
-
-    _log.info('Authenticating ...')
-    _send(sock, f'PASS {password}')
-    _send(sock, f'NICK {nick}')
-    _send(sock, f'USER {nick} {nick} {host} :{nick}')
-
-    _log.info('Joining channels ...')
-    for channel in channels:
-        _send(sock, f'JOIN {channel}')
-
-    _log.info('Receiving messages ...')
-    for line in _recv(sock):
-        if line is not None:
+    tls_context = ssl.create_default_context() if tls else None
+    reader, writer = await asyncio.open_connection(host, port,
+                                                   ssl=tls_context)
+
+    # Timers and tasks belong to the event loop of this connection, so
+    # any timer left over from a previous connection is discarded.
+    _ctx.timer = None
+    tasks = None
+    try:
+        # The asyncio transport already enables TCP_NODELAY.
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        _ctx.sock_buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                        _ctx.sock_buffer_size)
+
+        _log.info('Authenticating ...')
+        _send(writer, f'PASS {password}')
+        _send(writer, f'NICK {nick}')
+        _send(writer, f'USER {nick} {nick} {host} :{nick}')
+
+        _log.info('Joining channels ...')
+        for channel in channels:
+            _send(writer, f'JOIN {channel}')
+        await writer.drain()
+
+        _schedule_completion(writer)
+        tasks = asyncio.create_task(_run_tasks(state_filename))
+
+        _log.info('Receiving messages ...')
+        async for line in _recv(reader):
             sender, command, middle, trailing = _parse_line(line)
             if command == 'PING':
-                _send(sock, f'PONG :{trailing}')
+                _send(writer, f'PONG :{trailing}')
+                await writer.drain()
                 _ctx.retry_delay = 1
             elif command == 'PRIVMSG':
                 _log.info(
@@ -82,19 +124,51 @@ def _run(host, port, tls,
                 if (sender and middle and trailing and
                         trailing.startswith(prefix)):
                     try:
-                        _process_command(sock, nick, prefix, blocked_words,
-                                         sender, middle, trailing)
+                        await _process_command(writer, nick, prefix,
+                                               blocked_words, sender,
+                                               middle, trailing)
                     except Exception:
                         _log.exception('Command processor encountered error')
+                    _schedule_completion(writer)
+
+                    # Pause while the write buffer is above its high-water
+                    # mark, and raise if the connection is already lost.
+                    await writer.drain()
+    finally:
+        if tasks is not None:
+            tasks.cancel()
+        if _ctx.timer is not None:
+            _ctx.timer.cancel()
+        writer.close()
+        if _ctx.state_dirty:
+            _write_state(state_filename)
+            _ctx.state_dirty = False
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def _run_tasks(state_filename):
+    last_clean_time = 0
+    while True:
+        current_time = int(time.time())
         try:
-            _complete_timeboxes(sock)
-            _clean_timeboxes()
+            if current_time - last_clean_time >= _ctx.clean_delay:
+                _clean_timeboxes(current_time)
+                last_clean_time = current_time
+
+            # Write state only when it has changed and not more often
+            # than once every state_write_delay seconds.
+            if _ctx.state_dirty:
+                _write_state(state_filename)
+                _ctx.state_dirty = False
         except Exception:
             _log.exception('Task processor encountered error')
-        _write_state(state_filename)
+        await asyncio.sleep(_ctx.state_write_delay)
 
 
-def _set_up_commands():
+def _set_up_commands(prefix):
     _ctx.commands = {
         'begin': {
             'private': False,
@@ -140,9 +214,22 @@ def _set_up_commands():
         },
     }
 
+    # Map every prefix of every command name, including the empty
+    # prefix, to the list of commands that start with it.
+    _ctx.command_prefixes = {}
+    for command in _ctx.commands:
+        for i in range(len(command) + 1):
+            _ctx.command_prefixes.setdefault(command[:i], []).append(command)
+
+    # The prefix and the command set never change, so the command list
+    # and the usage text of each command can be formatted only once.
+    _ctx.command_list = _command_list(prefix, _ctx.commands)
+    for command, decl in _ctx.commands.items():
+        decl['usage'] = decl['help'](prefix, command)
+
 
-def _process_command(sock, nick, prefix, blocked_words,
-                     sender, recipient, message):
+async def _process_command(writer, nick, prefix, blocked_words,
+                           sender, recipient, message):
     # If this tool's nickname is same as the receiver name (recipient)
     # found in the received message, the message was sent privately to
     # this tool.
@@ -161,40 +248,41 @@ def _process_command(sock, nick, prefix, blocked_words,
     matches = _find_command(command)
     if len(matches) == 0:
         msg = ('Error: Unrecognized command.  Available commands: ' +
-               _command_list(prefix, _ctx.commands) + '.')
-        _send_message(sock, reply_to, msg)
+               _ctx.command_list + '.')
+        _send_message(writer, reply_to, msg)
         return
 
     if len(matches) > 1:
         msg = ('Error: Ambiguous command.  Matching commands: ' +
                _command_list(prefix, matches) + '.')
-        _send_message(sock, reply_to, msg)
+        _send_message(writer, reply_to, msg)
         return
 
     command = matches[0]
     decl = _ctx.commands[command]
     if private and not decl['private']:
         msg = 'Error: This command must be sent in channel.'
-        _send_message(sock, reply_to, msg)
+        _send_message(writer, reply_to, msg)
     elif not private and not decl['public']:
         msg = 'Error: This command must be sent in private.'
-        _send_message(sock, reply_to, msg)
-    elif any(word in params for word in blocked_words):
+        _send_message(writer, reply_to, msg)
+    elif not blocked_words.isdisjoint(params):
         msg = 'Error: Parameters contain blocked word.'
-        _send_message(sock, reply_to, msg)
+        _send_message(writer, reply_to, msg)
     else:
         action_func = decl['action']
         throttle_delay = 0
         for msg in action_func(prefix, sender, command, params, reply_to):
-            _send_message(sock, reply_to, msg)
-            time.sleep(throttle_delay)
+            _send_message(writer, reply_to, msg)
+            await writer.drain()
+            await asyncio.sleep(throttle_delay)
             throttle_delay = 1
 
 
 # Command ,begin
-def _begin_timebox(prefix, sender, command, params, reply_to):
+def _begin_timebox(_prefix, sender, command, params, reply_to):
     if len(params) == 0:
-        return ['Error: ' + _begin_timebox_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
 
     if params[0].isdigit():
         if len(params) == 1:
@@ -232,6 +320,8 @@ def _begin_timebox(prefix, sender, command, params, reply_to):
         'summary': summary,
         'completed': False,
     })
+    heapq.heappush(_ctx.deadlines, (_deadline(timeboxes[-1]), sender))
+    _ctx.state_dirty = True
     return ['Started timebox: ' + _format_timebox(timeboxes[-1])]
 
 
@@ -247,9 +337,9 @@ def _begin_timebox_help(prefix, command):
 
 
 # Command ,cancel
-def _cancel_timebox(prefix, sender, command, params, _reply_to):
+def _cancel_timebox(_prefix, sender, command, params, _reply_to):
     if len(params) > 0:
-        return ['Error: ' + _cancel_timebox_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
 
     timeboxes = _ctx.state['timebox'].get(sender)
     if timeboxes is None or timeboxes[-1]['completed']:
@@ -259,6 +349,7 @@ def _cancel_timebox(prefix, sender, command, params, _reply_to):
     del timeboxes[-1]
     if len(timeboxes) == 0:
         del _ctx.state['timebox'][sender]
+    _ctx.state_dirty = True
     return ['Cancelled running timebox: ' + _format_timebox(cancelled_timebox)]
 
 
@@ -268,9 +359,9 @@ def _cancel_timebox_help(prefix, command):
 
 
 # Command ,delete
-def _delete_timebox(prefix, sender, command, params, _reply_to):
+def _delete_timebox(_prefix, sender, command, params, _reply_to):
     if len(params) > 0:
-        return ['Error: ' + _delete_timebox_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
 
     timeboxes = _ctx.state['timebox'].get(sender)
     if timeboxes is None:
@@ -286,6 +377,7 @@ def _delete_timebox(prefix, sender, command, params, _reply_to):
     del timeboxes[-1]
     if len(timeboxes) == 0:
         del _ctx.state['timebox'][sender]
+    _ctx.state_dirty = True
     return ['Deleted the last completed timebox: ' +
             _format_timebox(deleted_timebox)]
 
@@ -297,32 +389,31 @@ def _delete_timebox_help(prefix, command):
 # Command ,help
 def _help(prefix, _sender, command, params, _reply_to):
     if len(params) == 0:
-        return _help_help(prefix, command)
+        return _ctx.commands[command]['usage']
 
     params[0] = _remove_prefix(params[0], prefix)
     matches = _find_command(params[0])
 
     if len(matches) == 0:
         return ['Error: Unrecognized command.  Available commands: ' +
-                _command_list(prefix, _ctx.commands) + '.']
+                _ctx.command_list + '.']
 
     if len(matches) > 1:
         return ['Error: Ambiguous command.  Matching commands: ' +
                 _command_list(prefix, matches) + '.']
 
-    cmd = matches[0]
-    return _ctx.commands[cmd]['help'](prefix, cmd)
+    return _ctx.commands[matches[0]]['usage']
 
 
 def _help_help(prefix, command):
     return [f'Usage: {prefix}{command} [COMMAND].  Available commands: ' +
-            _command_list(prefix, _ctx.commands) + '.']
+            _ctx.command_list + '.']
 
 
 # Command ,list
-def _list_completed_timeboxes(prefix, sender, command, params, _reply_to):
+def _list_completed_timeboxes(_prefix, sender, command, params, _reply_to):
     if len(params) > 0:
-        return ['Error: ' + _list_completed_timeboxes_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
 
     timeboxes = _ctx.state['timebox'].get(sender)
     if timeboxes is None:
@@ -332,7 +423,9 @@ def _list_completed_timeboxes(prefix, sender, command, params, _reply_to):
     if len(completed) == 0:
         return [f'No completed timeboxes found for {sender}.']
 
-    completed.sort(key=lambda x: x['start'], reverse=True)
+    # Timeboxes are appended in order of start time, so reversing the
+    # list is enough to show the most recent timebox first.
+    completed.reverse()
     return [_format_timebox(t) for t in completed]
 
 
@@ -346,9 +439,9 @@ def _list_completed_timeboxes_help(prefix, command):
 
 
 # Command ,running
-def _list_running_timeboxes(prefix, _sender, command, params, reply_to):
+def _list_running_timeboxes(_prefix, _sender, command, params, reply_to):
     if len(params) > 0:
-        return ['Error: ' + _list_running_timeboxes_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
 
     running = []
     for timeboxes in _ctx.state['timebox'].values():
@@ -359,6 +452,8 @@ def _list_running_timeboxes(prefix, _sender, command, params, reply_to):
     if len(running) == 0:
         return [f'No running timeboxes found for {reply_to}.']
 
+    # Running timeboxes belong to different people and are collected in
+    # no particular order, so they still need to be sorted.
     running.sort(key=lambda x: x['start'], reverse=True)
     return [_format_timebox(t) for t in running]
 
@@ -369,9 +464,9 @@ def _list_running_timeboxes_help(prefix, command):
 
 
 # Command ,time
-def _current_time(prefix, _sender, command, params, _reply_to):
+def _current_time(_prefix, _sender, command, params, _reply_to):
     if len(params) > 0:
-        return ['Error: ' + _current_time_help(prefix, command)[0]]
+        return ['Error: ' + _ctx.commands[command]['usage'][0]]
     return [time.strftime('%Y-%m-%d %H:%M:%S %Z', time.gmtime())]
 
 
@@ -380,46 +475,102 @@ def _current_time_help(prefix, command):
 
 
 # Tasks.
-def _complete_timeboxes(sock):
-    current_time = int(time.time())
-    for timeboxes in _ctx.state['timebox'].values():
-        last = timeboxes[-1]
-        if (not last['completed'] and
-                last['start'] + last['duration'] * 60 <= current_time):
-            last['completed'] = True
-            msg = 'Completed timebox: ' + _format_timebox(last)
-            _send_message(sock, last['reply_to'], msg)
+def _schedule_completion(writer):
+    # Arm a single timer for the earliest deadline.  It is re-armed
+    # whenever a command may have added an earlier deadline and after
+    # it fires.
+    if _ctx.timer is not None:
+        _ctx.timer.cancel()
+        _ctx.timer = None
+    if _ctx.deadlines:
+        delay = _ctx.deadlines[0][0] - time.time()
+        _ctx.timer = asyncio.get_running_loop().call_later(
+            delay, _complete_timeboxes, writer)
+
+
+def _complete_timeboxes(writer):
+    # Deadlines of cancelled or cleaned up timeboxes are left in the
+    # heap and skipped here when they are popped.
+    current_time = time.time()
+    try:
+        while _ctx.deadlines and _ctx.deadlines[0][0] <= current_time:
+            deadline, person = heapq.heappop(_ctx.deadlines)
+            timeboxes = _ctx.state['timebox'].get(person)
+            if timeboxes is None:
+                continue
+            last = timeboxes[-1]
+            if not last['completed'] and _deadline(last) == deadline:
+                last['completed'] = True
+                _ctx.state_dirty = True
+                msg = 'Completed timebox: ' + _format_timebox(last)
+                _send_message(writer, last['reply_to'], msg)
+    except Exception:
+        _log.exception('Task processor encountered error')
+    _schedule_completion(writer)
+
+
+def _clean_timeboxes(current_time):
+    max_timeboxes = 10
+    for person in list(_ctx.state['timebox']):
+        timeboxes = _ctx.state['timebox'][person]
 
+        # Timeboxes are appended in order of start time, so the expired
+        # ones are always at the beginning of the list.
+        expired = 0
+        while (expired < len(timeboxes) and
+               timeboxes[expired]['start'] + 2 * 86400 < current_time):
+            expired += 1
+        expired = max(expired, len(timeboxes) - max_timeboxes)
 
-def _clean_timeboxes():
-    current_time = int(time.time())
-    cleaned_state_timebox = {}
-    max_timeboxes = 10
-    for person, timeboxes in _ctx.state['timebox'].items():
-        cleaned_timeboxes = []
-        for timebox in timeboxes:
-            if current_time <= timebox['start'] + 2 * 86400:
-                cleaned_timeboxes.append(timebox)
-        cleaned_timeboxes = cleaned_timeboxes[-max_timeboxes:]
-        if len(cleaned_timeboxes) > 0:
-            cleaned_state_timebox[person] = cleaned_timeboxes
-    _ctx.state['timebox'] = cleaned_state_timebox
+        if expired > 0:
+            del timeboxes[:expired]
+            _ctx.state_dirty = True
+        if len(timeboxes) == 0:
+            del _ctx.state['timebox'][person]
 
 
 # Utility functions
 def _read_state(filename):
     if pathlib.Path(filename).exists():
-        with open(filename, encoding='utf-8') as stream:
-            _ctx.state = json.load(stream)
+        with open(filename, 'rb') as stream:
+            _ctx.state = _load_json(stream.read())
+
+    # Schedule the running timeboxes found in the state.
+    _ctx.deadlines = []
+    for person, timeboxes in _ctx.state['timebox'].items():
+        if not timeboxes[-1]['completed']:
+            _ctx.deadlines.append((_deadline(timeboxes[-1]), person))
+    heapq.heapify(_ctx.deadlines)
 
 
 def _write_state(filename):
-    with open(filename, 'w', encoding='utf-8') as stream:
-        json.dump(_ctx.state, stream, indent=2)
+    # Write to a temporary file and then rename it to the state file,
+    # so that a crash while writing never leaves a corrupt state file.
+    payload = _dump_json(_ctx.state)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as stream:
+        stream.write(payload)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def _load_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dump_json(obj):
+    # Use orjson when it is installed since it serializes much faster
+    # than the json module; otherwise fall back to compact json output.
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
 
 
 def _find_command(command):
-    return [c for c in _ctx.commands if c.startswith(command)]
+    return _ctx.command_prefixes.get(command, [])
 
 
 def _command_list(prefix, commands):
@@ -432,52 +583,65 @@ def _remove_prefix(word, prefix):
     return word
 
 
+def _deadline(timebox):
+    return timebox['start'] + timebox['duration'] * 60
+
+
 def _format_timebox(timebox):
     person = timebox['person']
     start = timebox['start']
     duration = timebox['duration']
     summary = timebox['summary']
-    start_str = time.strftime('%H:%M %Z', time.gmtime(start))
-    return f'{person} [{start_str}] ({duration} min) {summary}'
+    return f'{person} [{_format_start(start)}] ({duration} min) {summary}'
+
+
+@functools.lru_cache(maxsize=256)
+def _format_start(start):
+    return time.strftime('%H:%M %Z', time.gmtime(start))
 
 
 # Protocol functions
-def _recv(sock):
-    buffer = ''
+async def _recv(reader):
     while True:
-        # Check if any data has been received.
-        rlist, _, _ = select.select([sock], [], [], 1)
-        if len(rlist) == 0:
-            yield None
-            continue
-
-        # If data has been received, validate data length.
-        data = sock.recv(1024)
-        if len(data) == 0:
-            message = 'Received zero-length payload from server'
+        try:
+            data = await reader.readuntil(b'\r\n')
+        except asyncio.IncompleteReadError as e:
+            message = 'Connection closed by server'
             _log.error(message)
-            raise ValueError(message)
+            raise ValueError(message) from e
 
-        # If there is nonempty data, yield lines from it.
-        buffer += data.decode(errors='replace')
-        lines = buffer.split('\r\n')
-        lines, buffer = lines[:-1], lines[-1]
-        for line in lines:
-            _log.info('recv: %s', line)
-            yield line
+        line = data[:-2].decode(errors='replace')
+        _log.debug('recv: %s', line)
+        yield line
 
 
-def _send_message(sock, recipient, message):
+def _send_message(writer, recipient, message):
     size = 400
+    prefix = f'PRIVMSG {recipient} :'.encode()
+    out = bytearray()
     for line in message.splitlines():
-        chunks = [line[i:i + size] for i in range(0, len(line), size)]
-        for chunk in chunks:
-            _send(sock, f'PRIVMSG {recipient} :{chunk}')
-
-
-def _send(sock, message):
-    sock.sendall(message.encode() + b'\r\n')
-    _log.info('sent: %s', message)
+        data = line.encode()
+        start = 0
+        while start < len(data):
+            # Split at most size bytes off the line but never in the
+            # middle of a UTF-8 encoded character.
+            end = start + size
+            while end < len(data) and data[end] & 0xc0 == 0x80:
+                end -= 1
+            out += prefix
+            out += data[start:end]
+            out += b'\r\n'
+            start = end
+        _log.debug('sent: PRIVMSG %s :%s', recipient, line)
+
+    # Send all chunks of the message with a single call.
+    if out:
+        writer.write(out)
+
+
+def _send(writer, message):
+    writer.write((message + '\r\n').encode())
+    _log.debug('sent: %s', message)
 
 
 def _parse_line(line):
@@ -490,25 +654,29 @@ def _parse_line(line):
     #
     # Example: :alice!Alice@user/alice PRIVMSG #hello :hello
     # Example: PING :foo.example.com
-    if line[0] == ':':
-        prefix, rest = line[1:].split(maxsplit=1)
-    else:
-        prefix, rest = None, line
-
-    sender, command, middle, trailing = None, None, None, None
-
-    if prefix:
-        sender = prefix.split('!')[0]
-
-    rest = rest.split(None, 1)
-    command = rest[0].upper()
 
-    if len(rest) == 2:
-        params = rest[1]
-        params = params.split(':', 1)
-        middle = params[0].strip()
-        if len(params) == 2:
-            trailing = params[1].strip()
+    # Each field is split off with a single partition call, which
+    # avoids building intermediate lists for every received line.
+    sender, middle, trailing = None, None, None
+    rest = line
+    if line.startswith(':'):
+        prefix, _, rest = line[1:].lstrip(' ').partition(' ')
+        sender = prefix.partition('!')[0]
+
+    command, _, params = rest.lstrip(' ').partition(' ')
+    command = command.upper()
+
+    # Parameters are parsed only for PING and PRIVMSG messages.  For
+    # every other command, e.g., MOTD and NAMES replies, middle and
+    # trailing are returned as None.
+    if command not in ('PRIVMSG', 'PING'):
+        return sender, command, middle, trailing
+
+    params = params.lstrip(' ')
+    if params:
+        middle, colon, trailing = params.partition(':')
+        middle = middle.strip()
+        trailing = trailing.strip() if colon else None
 
     return sender, command, middle, trailing
 